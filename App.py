@@ -48,7 +48,7 @@
 #  OUTPUTS:  
 #  RESULTS folder: Contains the stack images in tif files of the bands of each month obtained from the "DATA" folder. 
 #                  Contains the folders "RGB" and "FalseColor" which contain their respective images for each month
-#                  of the year in png format.
+#                  of the year in png format, and the folder "Display" with downsampled copies of them shown in App.py.
 #  App.py: Streamlit application that visualizes the images created in RGB-NDSI.py.
 #  
 #  SIDE EFFECTS:  
@@ -76,13 +76,39 @@
 
 
 import streamlit as st
-from PIL import Image
+from pathlib import Path
 
 st.set_page_config(page_title="Evolution of snow in the South-West Alps", page_icon=":earth_americas:", layout="wide", initial_sidebar_state="expanded")
 
-@st.cache
-def load_image(image_path):
-    return Image.open(image_path)
+MONTHS = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
+
+# Paths of the RGB and False Color images of every month, built once with pathlib so they work on any OS.
+# Each image lists the downsampled display copy first and the full resolution image as a fallback
+PATHS = {month_name: ((Path("Results", "Display", "RGB", f"{month_name}_RGB.png"),
+                       Path("Results", "RGB", f"{month_name}_RGB.png")),
+                      (Path("Results", "Display", "FalseColor", f"{month_name}_FalseColor.png"),
+                       Path("Results", "FalseColor", f"{month_name}_FalseColor.png")))
+         for month_name in MONTHS}
+
+def read_image(image_paths):
+    # Use the first image that exists. Images that have not been created yet are stored as None,
+    # so only their month shows a warning
+    for image_path in image_paths:
+        if image_path.exists():
+            return image_path.read_bytes()
+    return None
+
+@st.cache_resource
+def all_images():
+    # Load the RGB and False Color PNG bytes of every month once, so moving the slider is a dictionary lookup
+    return {month_name: (read_image(rgb_paths), read_image(false_color_paths))
+            for month_name, (rgb_paths, false_color_paths) in PATHS.items()}
+
+def show_image(image, image_paths):
+    if image is None:
+        st.warning(f"{image_paths[0]} was not found. Run RGB-NDSI.py to create it.")
+    else:
+        st.image(image, width="stretch")
 
 def main():
     st.sidebar.title("Evolution of snow in 2024 in the South-West Alps: Piedmont, Italy")
@@ -90,16 +116,22 @@ def main():
     st.sidebar.write("This program visualizes the evolution of snow in the South-West Alps near Piedmont Italy during 2024 using Sentinel-2 satellite imagery. It consists of an image per month of the year")
 
     month = st.sidebar.slider("Choose a month", 1, 12, 1, format="%d")
-    month_name = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"][month-1]
+    month_name = MONTHS[month-1]
+    images = all_images()
+    if any(image is None for month_images in images.values() for image in month_images):
+        # Do not keep missing images in the cache, so they show up once RGB-NDSI.py has created them
+        all_images.clear()
+    rgb_image, false_color_image = images[month_name]
+    rgb_paths, false_color_paths = PATHS[month_name]
     st.write(f"You selected: {month_name}")
 
     col1, col2 = st.columns(2)
     with col1:
         st.write("RGB or True Color Image")
-        st.image(f"Results\RGB\{month_name}_RGB.png", use_column_width=True)
+        show_image(rgb_image, rgb_paths)
     with col2:
         st.write("False Color Image")  
-        st.image(f"Results\FalseColor\{month_name}_FalseColor.png", use_column_width=True)  
+        show_image(false_color_image, false_color_paths)  
 
     
 
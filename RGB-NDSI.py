@@ -48,7 +48,7 @@
 #  OUTPUTS:  
 #  RESULTS folder: Contains the stack images in tif files of the bands of each month obtained from the "DATA" folder. 
 #                  Contains the folders "RGB" and "FalseColor" which contain their respective images for each month
-#                  of the year in png format.
+#                  of the year in png format, and the folder "Display" with downsampled copies of them shown in App.py.
 #  App.py: Streamlit application that visualizes the images created in RGB-NDSI.py.
 #  
 #  SIDE EFFECTS:  
@@ -76,10 +76,16 @@
 
 #%% Stacking the sentinel bands into a single tif file with bands 2, 3, 4, 8, and 11
 import os
+import warnings
 import rasterio
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from rasterio.merge import merge
-from matplotlib import pyplot as plt
+from rasterio.enums import Resampling
+from rasterio.errors import NotGeoreferencedWarning, RasterioIOError
+from rasterio.io import MemoryFile
+import numba
+from numba import njit, prange, set_num_threads
 
 # Get the directory where the script is located
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -91,150 +97,225 @@ output_dir = os.path.join(script_dir, "Results")
 # List of bands to process
 bands = ["B2.jp2", "B3.jp2", "B4.jp2", "B8.jp2", "B11.jp2"]
 
+# Set to True to stack the bands again even if the stacked TIFF of a month already exists and is current
+force_rebuild = False
+
+# GDAL settings shared by every month: a larger block cache for the JP2 decoder and no directory
+# listing when a file is opened. GDAL_NUM_THREADS is set per worker by init_worker
+gdal_options = {"GDAL_CACHEMAX": "512", "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR"}
+
+# Function to split the cores between worker processes, returning the number of workers and the number
+# of threads each one may use, so the pool never runs more Numba or GDAL threads than there are cores.
+# The cores are counted as Numba's thread limit, which follows the CPUs this process may use (CPU affinity,
+# containers, NUMBA_NUM_THREADS) rather than os.cpu_count(), so set_num_threads always accepts the result
+def pool_size(n_tasks):
+    n_cores = max(1, numba.config.NUMBA_NUM_THREADS)
+    n_workers = max(1, min(n_cores, n_tasks))
+    n_threads = min(n_cores, max(1, n_cores // n_workers))
+    return n_workers, n_threads
+
+# Function run once in every worker process before it opens any dataset. GDAL reads its configuration
+# options from environment variables, so setting them here applies them for the lifetime of the worker
+# to every month it processes, with no rasterio.Env context left open or entered again per month
+def init_worker(n_threads):
+    os.environ.update(gdal_options, GDAL_NUM_THREADS=str(n_threads))
+    set_num_threads(n_threads)
+
 # Ensure the output directory exists
 os.makedirs(output_dir, exist_ok=True)
 
-# Loop through each month folder
-for month_folder in sorted(os.listdir(base_dir)):
-    month_path = os.path.join(base_dir, month_folder)
-    
-    if not os.path.isdir(month_path):
-        continue  # Skip files, only process directories
-    
-    band_paths = []
-    for band_file in bands:
-        band_path = os.path.join(month_path, band_file)
-        if os.path.exists(band_path):
-            band_paths.append(band_path)
-        else:
-            print(f"Warning: {band_file} not found in {month_folder}")
-    
-    if len(band_paths) != len(bands):
-        print(f"Skipping {month_folder} due to missing bands")
-        continue
-    
-    # Read the bands and write them into a single multi-band TIFF
-    output_tiff = os.path.join(output_dir, f"{month_folder}.tif")
-    
+# Function to check that an existing stack can be reused: it has to be a complete, tiled GeoTIFF
+# with every band, which excludes stacks from older versions of this script and unreadable files
+def is_current_stack(output_tiff):
+    try:
+        with rasterio.open(output_tiff) as src:
+            return src.driver == "GTiff" and src.profile.get("tiled", False) and src.count == len(bands)
+    except RasterioIOError:
+        return False
+
+# Function to read the bands of one month and write them into a single multi-band TIFF
+def stack_month(band_paths, output_tiff):
+    # Write to a temporary file first and move it into place when it is complete,
+    # so a crashed run never leaves a partial stack under the final name
+    temp_tiff = f"{output_tiff}.tmp"
+    # Open every band once, writing it into the output as soon as it is read so only one band
+    # is held in memory at a time
     with rasterio.open(band_paths[0]) as src0:
         meta = src0.meta
+        
+        # Update metadata for a tiled, compressed multi-band GeoTIFF. The metadata copied
+        # from the JP2 bands would otherwise keep the JP2 driver for the output. Band interleaving
+        # lets each band be written on its own without rewriting tiles that hold the others.
+        # The number of compression threads follows the worker's GDAL_NUM_THREADS
+        meta.update(count=len(band_paths), driver="GTiff", tiled=True, blockxsize=512, blockysize=512,
+                    compress="deflate", predictor=2, interleave="band", BIGTIFF="IF_SAFER")
+        
+        with rasterio.open(temp_tiff, 'w', **meta) as dst:
+            dst.write(src0.read(1), 1)
+            for idx, band_path in enumerate(band_paths[1:], start=2):
+                with rasterio.open(band_path) as src:
+                    dst.write(src.read(1), idx)
     
-    # Update metadata for multi-band TIFF
-    meta.update(count=len(bands))
-    
-    with rasterio.open(output_tiff, 'w', **meta) as dst:
-        for idx, band_path in enumerate(band_paths, start=1):
-            with rasterio.open(band_path) as src:
-                dst.write(src.read(1), idx)
-    
+    os.replace(temp_tiff, output_tiff)
     print(f"Created {output_tiff}")
 
-print("Processing complete!")
+if __name__ == "__main__":
+    month_band_paths = []
+    output_tiffs = []
+
+    # Loop through each month folder
+    for month_folder in sorted(os.listdir(base_dir)):
+        month_path = os.path.join(base_dir, month_folder)
+        
+        if not os.path.isdir(month_path):
+            continue  # Skip files, only process directories
+        
+        band_paths = []
+        for band_file in bands:
+            band_path = os.path.join(month_path, band_file)
+            if os.path.exists(band_path):
+                band_paths.append(band_path)
+            else:
+                print(f"Warning: {band_file} not found in {month_folder}")
+        
+        if len(band_paths) != len(bands):
+            print(f"Skipping {month_folder} due to missing bands")
+            continue
+        
+        output_tiff = os.path.join(output_dir, f"{month_folder}.tif")
+        if not force_rebuild and is_current_stack(output_tiff):
+            print(f"Skipping {month_folder}, {output_tiff} is already a current stack")
+            continue
+        
+        month_band_paths.append(band_paths)
+        output_tiffs.append(output_tiff)
+
+    # The months are independent, so stack them in parallel processes
+    n_workers, n_threads = pool_size(len(output_tiffs))
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(n_threads,)) as executor:
+        list(executor.map(stack_month, month_band_paths, output_tiffs))
+
+    print("Processing complete!")
 
-#%% Converting images to RGB (True-Color) and NDSI (Normalized Difference Snow Index)
+#%% Converting images to RGB (True-Color) and False Color
 
 # Define paths
 input_dir = "./Results"  # Directory containing the multi-band TIFFs
-output_dir = "./Results/RGB"  # Directory to save RGB images
+rgb_dir = "./Results/RGB"  # Directory to save RGB images
+false_color_dir = "./Results/FalseColor"  # Directory to save false color images
+rgb_display_dir = "./Results/Display/RGB"  # Directory to save the downsampled RGB images shown in App.py
+false_color_display_dir = "./Results/Display/FalseColor"  # Directory to save the downsampled false color images shown in App.py
 
-# Ensure the output directory exists
-os.makedirs(output_dir, exist_ok=True)
+# Ensure the output directories exist
+for directory in [rgb_dir, false_color_dir, rgb_display_dir, false_color_display_dir]:
+    os.makedirs(directory, exist_ok=True)
+
+# Sentinel-2 Level-2A products from processing baseline 04.00 on (January 2022, so all the 2024 data used
+# here) store surface reflectance as (DN + BOA_ADD_OFFSET) / 10000 with BOA_ADD_OFFSET = -1000. The offset
+# is listed in the MTD_MSIL2A.xml metadata of each product; set it to 0 for products from older baselines
+boa_add_offset = -1000.0
+reflectance_scale = 1.0 / 10000.0
 
-# Function to normalize band data to [0, 1]
-def normalize_band(band):
-    band_min, band_max = band.min(), band.max()
-    return (band - band_min) / (band_max - band_min)
+# Kernel to convert a planar (bands, rows, cols) image to reflectance clipped to [0, 1], quantize it
+# to 8 bits and apply a lookup table in a single pass, writing the result into the planar array out.
+# The no-data value 0 falls below 0 after the offset is added, so it is clamped and stays black
+@njit(parallel=True, fastmath=True, cache=True)
+def reflectance_lut(image, offset, scale, lut, out):
+    n_bands, rows, cols = image.shape
+    offset = np.float32(offset)
+    scale = np.float32(scale)
+    # The inner loop walks along a row of a single band, which is contiguous in memory
+    for i in prange(rows):
+        for c in range(n_bands):
+            for j in range(cols):
+                v = (np.float32(image[c, i, j]) + offset) * scale
+                v = min(max(v, np.float32(0.0)), np.float32(1.0))
+                out[c, i, j] = lut[int(v * np.float32(255.0) + np.float32(0.5))]
 
-# Function to apply brightness and gamma correction
-def apply_brightness_gamma(rgb_image, brightness_factor=1, gamma=2):
+# Function to build a 256-entry lookup table that applies brightness and gamma correction to 8-bit values
+def brightness_gamma_lut(brightness_factor=1, gamma=2):
     # Apply brightness scaling
-    brightened = np.clip(rgb_image * brightness_factor, 0, 1)
+    levels = np.clip(np.arange(256) / 255.0 * brightness_factor, 0, 1)
     # Apply gamma correction
-    corrected = np.power(brightened, 1 / gamma)
-    return corrected
-
-# Process each multi-band TIFF
-for tiff_file in sorted(os.listdir(input_dir)):
-    if tiff_file.endswith(".tif"):
-        tiff_path = os.path.join(input_dir, tiff_file)
-        output_image = os.path.join(output_dir, tiff_file.replace(".tif", "_RGB.png"))
-        
-        with rasterio.open(tiff_path) as src:
-            # Read the bands: Red (3), Green (2), Blue (1)
-            red = src.read(3)
-            green = src.read(2)
-            blue = src.read(1)
-        
-        # Normalize bands to [0, 1]
-        red_normalized = normalize_band(red)
-        green_normalized = normalize_band(green)
-        blue_normalized = normalize_band(blue)
-        
-        # Stack bands to create an RGB image
-        rgb_image = np.stack([red_normalized, green_normalized, blue_normalized], axis=-1)
-        
-        # Apply brightness and gamma correction
-        brightness_factor = 1.2  # Adjust as per SatMapper-like approach
-        gamma = 2.2
-        rgb_image_corrected = apply_brightness_gamma(rgb_image, brightness_factor, gamma)
-        
-        # Display the RGB image
-        plt.figure(figsize=(10, 10))
-        plt.imshow(rgb_image_corrected)
-        plt.title(f"True-Color Image (Corrected): {tiff_file}")
-        plt.axis("off")
-        plt.show()
-        
-        # Save the RGB image as PNG
-        plt.imsave(output_image, rgb_image_corrected)
-        print(f"Saved SatMapper-like RGB image: {output_image}")
+    return np.clip(np.round(np.power(levels, 1 / gamma) * 255), 0, 255).astype(np.uint8)
 
-print("Processing complete!")
+# Brightness and gamma correction, computed once for every image
+brightness_factor = 1.2  # Adjust as per SatMapper-like approach
+gamma = 2.2
+lut = brightness_gamma_lut(brightness_factor, gamma)
 
-#%% Calculating the NDSI
+# Lookup table that leaves the 8-bit values unchanged, as no correction is applied to false color images
+identity_lut = np.arange(256, dtype=np.uint8)
 
-# Define paths
-input_dir = "./Results"  # Directory containing the multi-band TIFFs
-output_dir = "./Results/FalseColor"  # Directory to save false color images
+# Function to render the RGB and false color images of an open multi-band TIFF in a single pass,
+# streaming it block by block so only one block of the raster is in memory at a time
+def render_images(src):
+    # Read Blue (1), Green (2), Red (3) and NIR (4) together, which are bands 2, 3, 4 and 8 of Sentinel-2
+    indexes = [1, 2, 3, 4]
 
-# Ensure the output directory exists
-os.makedirs(output_dir, exist_ok=True)
+    # Both images are kept planar (bands, rows, cols), the same layout rasterio reads
+    rgb_image = np.empty((3, src.height, src.width), dtype=np.uint8)
+    false_color_image = np.empty((3, src.height, src.width), dtype=np.uint8)
+    for _, window in src.block_windows(1):
+        block = src.read(indexes, window=window)
+        rows, cols = window.toslices()
+        # RGB uses Red, Green, Blue with brightness and gamma correction, false color uses NIR, Red, Green.
+        # Both are rendered from views of the same block, so every band is decoded only once
+        reflectance_lut(block[2::-1], boa_add_offset, reflectance_scale, lut, rgb_image[:, rows, cols])
+        reflectance_lut(block[3:0:-1], boa_add_offset, reflectance_scale, identity_lut, false_color_image[:, rows, cols])
+    return rgb_image, false_color_image
 
-# Function to normalize band data to [0, 1]
-def normalize_band(band):
-    band_min, band_max = band.min(), band.max()
-    return (band - band_min) / (band_max - band_min)
+# Longest side in pixels of the images shown in App.py
+display_size = 1024
 
-# Process each multi-band TIFF
-for tiff_file in sorted(os.listdir(input_dir)):
-    if tiff_file.endswith(".tif"):
-        tiff_path = os.path.join(input_dir, tiff_file)
-        output_image = os.path.join(output_dir, tiff_file.replace(".tif", "_FalseColor.png"))
-        
-        with rasterio.open(tiff_path) as src:
-            # Read the bands: NIR (4), Red (3), Green (2)
-            nir = src.read(4)  # Band 8 (Near-Infrared)
-            red = src.read(3)  # Band 4 (Red)
-            green = src.read(2)  # Band 3 (Green)
-        
-        # Normalize bands to [0, 1] for visualization
-        nir_normalized = normalize_band(nir)
-        red_normalized = normalize_band(red)
-        green_normalized = normalize_band(green)
-        
-        # Stack bands to create a false-color composite
-        false_color_image = np.stack([nir_normalized, red_normalized, green_normalized], axis=-1)
-        
-        # Save the false color image as PNG
-        plt.figure(figsize=(10, 10))
-        plt.imshow(false_color_image)
-        plt.title(f"False Color Composite: {tiff_file}")
-        plt.axis("off")
-        plt.show()
-        
-        # Save the RGB image as PNG
-        plt.imsave(output_image, false_color_image)
-        print(f"Saved SatMapper-like RGB image: {output_image}")
+# Function to encode a planar (bands, rows, cols) 8-bit image with GDAL's PNG driver and write it to disk.
+# If out_shape is given, a bilinear downsampled copy is read back from the in-memory dataset before
+# it is encoded and returned, so the PNG never has to be decoded again
+def write_png(image, output_image, out_shape=None):
+    bands, height, width = image.shape
+    resampled = None
+    with warnings.catch_warnings():
+        # The PNG images have no georeferencing, which is expected
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        with MemoryFile() as memfile:
+            with memfile.open(driver="PNG", count=bands, height=height, width=width, dtype="uint8", ZLEVEL=1) as dst:
+                dst.write(image)
+                if out_shape is not None:
+                    resampled = dst.read(out_shape=out_shape, resampling=Resampling.bilinear)
+            with open(output_image, "wb") as f:
+                f.write(memfile.read())
+    return resampled
+
+# Function to save a planar 8-bit image as PNG, together with a copy downsampled for display that keeps its aspect ratio
+def save_image(image, output_image, display_image):
+    bands, height, width = image.shape
+    factor = min(1.0, display_size / max(height, width))
+    display_shape = (bands, max(1, round(height * factor)), max(1, round(width * factor)))
+    display = write_png(image, output_image, out_shape=display_shape)
+    write_png(display, display_image)
+
+# Function to create the RGB and false color images of one multi-band TIFF
+def process_month(tiff_path, rgb_image_path, rgb_display_path, false_color_image_path, false_color_display_path):
+    with rasterio.open(tiff_path) as src:
+        rgb_image, false_color_image = render_images(src)
+
+    save_image(rgb_image, rgb_image_path, rgb_display_path)
+    print(f"Saved SatMapper-like RGB image: {rgb_image_path}")
+    save_image(false_color_image, false_color_image_path, false_color_display_path)
+    print(f"Saved false color image: {false_color_image_path}")
+
+if __name__ == "__main__":
+    # Process each multi-band TIFF, one month per process
+    tiff_files = [tiff_file for tiff_file in sorted(os.listdir(input_dir)) if tiff_file.endswith(".tif")]
+    tiff_paths = [os.path.join(input_dir, tiff_file) for tiff_file in tiff_files]
+    rgb_image_paths = [os.path.join(rgb_dir, tiff_file.replace(".tif", "_RGB.png")) for tiff_file in tiff_files]
+    rgb_display_paths = [os.path.join(rgb_display_dir, tiff_file.replace(".tif", "_RGB.png")) for tiff_file in tiff_files]
+    false_color_image_paths = [os.path.join(false_color_dir, tiff_file.replace(".tif", "_FalseColor.png")) for tiff_file in tiff_files]
+    false_color_display_paths = [os.path.join(false_color_display_dir, tiff_file.replace(".tif", "_FalseColor.png")) for tiff_file in tiff_files]
 
-print("Processing complete!")
+    n_workers, n_threads = pool_size(len(tiff_paths))
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(n_threads,)) as executor:
+        list(executor.map(process_month, tiff_paths, rgb_image_paths, rgb_display_paths,
+                          false_color_image_paths, false_color_display_paths))
 
+    print("Processing complete!")